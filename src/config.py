@@ -15,6 +15,17 @@ FIELD_NAMES = frozenset(DEFAULT_VALUES.keys())
 
 class ConfigScreen(Screen):
 
+    def on_kv_post(self, base_widget):
+        """
+        Keep references to the text inputs, so that these do not have to be
+        looked up among the ids every time.
+
+        Called once the kv rules have been applied to this screen.
+        """
+        self.fields = {
+            field_name: self.ids[field_name] for field_name in FIELD_NAMES
+        }
+
     def on_pre_enter(self):
         """
         Set the values of the text inputs. Assume that self.config has been
@@ -24,25 +35,22 @@ class ConfigScreen(Screen):
         """
         assert self.config
 
-        for field_name in FIELD_NAMES:
-            field = getattr(self.ids, field_name)
+        for field_name, field in self.fields.items():
             field.text = self.config.get(SECTION_NAME, field_name)
 
     def reset_field(self, field_name):
         """
         Reset the value of the given field to its default.
         """
-        field = getattr(self.ids, field_name)
-        field.text = DEFAULT_VALUES[field_name]
+        self.fields[field_name].text = DEFAULT_VALUES[field_name]
 
     def update_config(self):
         """
         Update the config with the values that happen to be in the input fields
         when the user calls this action.
         """
-        for field_name in FIELD_NAMES:
-            value = getattr(self.ids, field_name).text
-            self.config.set(SECTION_NAME, field_name, value)
+        for field_name, field in self.fields.items():
+            self.config.set(SECTION_NAME, field_name, field.text)
 
         self.config.write()
 
@@ -1,10 +1,16 @@
 import mimetypes
 import os
+from collections import OrderedDict
 
 from kivy.utils import platform as PLATFORM
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThread
 
 
-if PLATFORM == 'android':
+IS_ANDROID = PLATFORM == 'android'
+
+if IS_ANDROID:
     import android.activity
     from android import mActivity
     from android.permissions import Permission
@@ -19,16 +25,34 @@ if PLATFORM == 'android':
     Environment = autoclass('android.os.Environment')
     FileProvider = autoclass('android.support.v4.content.FileProvider')
 
+    DIRECTORY_DOWNLOADS = Environment.DIRECTORY_DOWNLOADS
+
     class AndroidUriResolver(AndroidFileChooser):
         """
         Leverage Plyer's file chooser for resolving Android URIs.
+
+        The last few resolved paths are cached by URI, so that sharing the same
+        file again (e.g. after mistyping the code) does not involve querying
+        the content provider again.
         """
+        cache_size = 8
 
         def __init__(self):
-            pass
+            self.cache = OrderedDict()
 
         def resolve(self, uri):
-            return self._resolve_uri(uri)
+            key = uri.toString()
+
+            path = self.cache.pop(key, None)
+            if path is None or not os.path.isfile(path):
+                path = self._resolve_uri(uri)
+
+            if path:
+                self.cache[key] = path
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+            return path
 
 
 """
@@ -36,6 +60,11 @@ permissions
 """
 
 
+# Android kills the app's process if the user revokes a permission, so once
+# granted, the permission can be relied upon for the rest of the process' life
+storage_perms_granted = False
+
+
 def ensure_storage_perms(fallback_func):
     """
     Decorator that ensures that the decorated function is only run if the user
@@ -44,25 +73,36 @@ def ensure_storage_perms(fallback_func):
 
     Because permissions on Android are requested asynchronously, the decorated
     function should not be expected to return a value.
+
+    Once the permissions are granted, the check is skipped for subsequent
+    calls. On other platforms the decorated function is returned as it is.
     """
     def outer_wrapper(func):
+        if not IS_ANDROID:
+            return func
+
         def inner_wrapper(*args, **kwargs):
-            if PLATFORM == 'android':
-                if check_permission(Permission.WRITE_EXTERNAL_STORAGE):
-                    return func(*args, **kwargs)
+            global storage_perms_granted
+
+            if storage_perms_granted:
+                return func(*args, **kwargs)
 
-                def callback(permissions, grant_results):
-                    if grant_results[0]:
-                        return func(*args, **kwargs)
-                    else:
-                        return fallback_func()
+            if check_permission(Permission.WRITE_EXTERNAL_STORAGE):
+                storage_perms_granted = True
+                return func(*args, **kwargs)
 
-                request_permissions(
-                    [Permission.WRITE_EXTERNAL_STORAGE], callback
-                )
-                return
+            def callback(permissions, grant_results):
+                global storage_perms_granted
 
-            return func(*args, **kwargs)
+                if grant_results[0]:
+                    storage_perms_granted = True
+                    return func(*args, **kwargs)
+                else:
+                    return fallback_func()
+
+            request_permissions(
+                [Permission.WRITE_EXTERNAL_STORAGE], callback
+            )
 
         return inner_wrapper
     return outer_wrapper
@@ -73,15 +113,24 @@ directories
 """
 
 
+# the Android storage path is looked up via JNI and does not change while the
+# app is running, so it is only looked up once
+android_downloads_dir = None
+
+
 def get_downloads_dir():
     """
     Return the path to the user's downloads dir.
     """
-    if PLATFORM == 'android':
-        return os.path.join(
-            primary_external_storage_path(),
-            Environment.DIRECTORY_DOWNLOADS
-        )
+    if IS_ANDROID:
+        global android_downloads_dir
+
+        if android_downloads_dir is None:
+            android_downloads_dir = os.path.join(
+                primary_external_storage_path(), DIRECTORY_DOWNLOADS
+            )
+
+        return android_downloads_dir
     else:
         return os.getcwd()
 
@@ -108,7 +157,7 @@ def open_file(path):
     """
     mime_type, _ = mimetypes.guess_type(path)
 
-    if PLATFORM == 'android':
+    if IS_ANDROID:
         uri = FileProvider.getUriForFile(
             mActivity, 'com.pavelsof.wormhole.fileprovider', File(path)
         )
@@ -138,8 +187,9 @@ class IntentHandler:
         """
         self.data = None
         self.error = None
+        self.resolving = succeed(None)
 
-        if PLATFORM == 'android':
+        if IS_ANDROID:
             self.uri_resolver = AndroidUriResolver()
             self.handle_android_intent(mActivity.getIntent())
             android.activity.bind(on_new_intent=self.handle_android_intent)
@@ -147,13 +197,13 @@ class IntentHandler:
     def handle_android_intent(self, intent):
         """
         Handle incoming ACTION_SEND intents on Android.
+
+        Except for the launching intent, this is called on Android's UI thread,
+        so the URI is handed over to the reactor's thread to be resolved there.
         """
         if intent.getAction() != 'android.intent.action.SEND':
             return
 
-        self.data = None
-        self.error = None
-
         try:
             if intent.getData():
                 uri = intent.getData()
@@ -165,19 +215,70 @@ class IntentHandler:
                 assert clipData.getItemCount()
 
                 uri = clipData.getItemAt(0).getUri()
-
-            self.data = self.uri_resolver.resolve(uri)
         except (AttributeError, AssertionError):
-            self.error = (
-                'Your share target cannot be recognised as a file. '
-                'If it is indeed one, '
-                'please try selecting it via the file chooser instead.'
-            )
+            uri = None
+
+        reactor.callFromThread(self.resolve_uri, uri)
+
+    def resolve_uri(self, uri):
+        """
+        Resolve the given URI into a file path and put the latter in the
+        buffer; or put an error there if the URI is None.
+
+        Resolving the URI might involve querying the content provider or even
+        copying the file, so this is done in a worker thread.
+        """
+        self.data = None
+        self.error = None
+
+        if uri is None:
+            return self.set_error()
+
+        self.resolving = deferToThread(self.uri_resolver.resolve, uri)
+        self.resolving.addCallbacks(self.set_data, self.set_error)
+
+    def set_data(self, data):
+        """
+        Put the resolved file path in the buffer.
+        """
+        self.data = data
+
+    def set_error(self, failure=None):
+        """
+        Put an error in the buffer instead of a file path.
+        """
+        self.error = (
+            'Your share target cannot be recognised as a file. '
+            'If it is indeed one, '
+            'please try selecting it via the file chooser instead.'
+        )
 
     def pop(self):
         """
-        If there is a file path in our improvised single-slot buffer, pop it.
-        If there is an error instead, raise it. Otherwise return None.
+        Return a Deferred that fires once any URI that is being resolved is
+        done with. If there is a file path in our improvised single-slot buffer
+        by then, pop it. If there is an error instead, reject with it as a
+        ValueError. Otherwise resolve into None.
+
+        The check is queued in the same way as the URIs in
+        handle_android_intent, so that it comes after any URI handed over
+        before it.
+        """
+        deferred = Deferred()
+
+        def wait_for_resolving():
+            self.resolving.addBoth(lambda _: deferred.callback(None))
+
+        reactor.callFromThread(wait_for_resolving)
+
+        deferred.addCallback(lambda _: self.pop_now())
+        return deferred
+
+    def pop_now(self):
+        """
+        Pop the file path or raise the error from the buffer, if any.
+
+        Helper for the pop method above.
         """
         if self.error:
             error = str(self.error)
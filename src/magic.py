@@ -1,15 +1,45 @@
 import hashlib
-import json
+import mmap
 import os
+from collections import namedtuple
+from hmac import compare_digest
 
 import wormhole.errors
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue, TimeoutError
-from twisted.protocols.basic import FileSender
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, inlineCallbacks, maybeDeferred, returnValue,
+    succeed, TimeoutError
+)
+from twisted.internet.interfaces import IPullProducer
+from twisted.internet.threads import deferToThread
 from wormhole import create
 from wormhole.cli.cmd_send import APPID
 from wormhole.cli.public_relay import RENDEZVOUS_RELAY, TRANSIT_RELAY
 from wormhole.transit import TransitReceiver, TransitSender
+from zope.interface import implementer
+
+try:  # orjson serialises straight to bytes and is the fastest, but optional
+    from orjson import dumps as dump_json, loads as load_json
+except ImportError:
+    try:  # ujson is the second best
+        import ujson as json
+    except ImportError:
+        import json
+
+    def dump_json(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    load_json = json.loads
+
+
+# messages that never change, serialised once and for all
+FILE_ACK_MESSAGE = dump_json({'answer': {'file_ack': 'ok'}})
+
+# the hex digest is safe to put in a JSON string as it is
+TRANSFER_ACK_TEMPLATE = b'{"ack": "ok", "sha256": "%b"}'
+
+# a serialised offer message along with the file details that went into it
+Offer = namedtuple('Offer', ['message', 'file_name', 'file_size'])
 
 
 class ConnectionError(Exception):
@@ -52,6 +82,177 @@ class TransferError(Exception):
     verbose_name = 'Transfer error'
 
 
+@implementer(IPullProducer)
+class HashingFileSender:
+    """
+    Producer that sends the contents of a file to a consumer and also computes
+    the SHA-256 hash of the data sent. Based on Twisted's FileSender, but
+    without the per-chunk transform function.
+
+    The hashing is done in the reactor's thread pool, one chunk after another,
+    so that it runs alongside the network I/O rather than holding up the
+    reactor thread. At most max_pending chunks can be waiting to be hashed;
+    when this limit is reached, the sender stops reading from the file until
+    the hashing catches up.
+
+    The chunks are much larger than FileSender's default of 16 KiB, which cuts
+    down the number of reactor round trips and hasher calls per file.
+
+    If MMAP_THRESHOLD is set, files larger than it are memory-mapped if the
+    platform allows it. Then the whole mapping is hashed in one go in a worker
+    thread, while the chunks are read from the mapping and sent. This is off
+    by default: if a mapped file is truncated during the transfer (e.g. a
+    shared file that is still being written), touching the missing pages
+    raises SIGBUS and kills the whole app, whereas reading the file merely
+    cuts the transfer short, which the other side then reports as a failure.
+    """
+    CHUNK_SIZE = 2 ** 20
+    MMAP_THRESHOLD = None
+
+    def __init__(self, max_pending=8):
+        self.hasher = hashlib.sha256()
+        self.hashed = succeed(None)
+        self.semaphore = DeferredSemaphore(max_pending)
+
+        self.file = None
+        self.mapping = None
+        self.consumer = None
+        self.on_chunk = None
+        self.deferred = None
+
+    def beginFileTransfer(self, file, consumer, on_chunk=None):
+        """
+        Begin transferring the file, hashing the data along the way. If given,
+        the on_chunk function is called with each chunk after it is written to
+        the consumer.
+
+        Return a Deferred that resolves when the whole file has been written
+        to the consumer, though not necessarily hashed yet.
+        """
+        self.file = file
+        self.consumer = consumer
+        self.on_chunk = on_chunk
+
+        self.map_file()
+
+        self.deferred = Deferred()
+        self.consumer.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        """
+        Send the next chunk of the file as soon as there is room for it in the
+        hashing queue.
+
+        Called by the consumer whenever it is ready for more data.
+        """
+        deferred = self.semaphore.acquire()
+        deferred.addCallback(self.send_chunk)
+
+    def send_chunk(self, _):
+        """
+        Read the next chunk of the file, queue it for hashing, and write it to
+        the consumer. If the end of the file is reached, finish the transfer.
+        """
+        if self.deferred is None:  # the transfer has been stopped meanwhile
+            self.semaphore.release()
+            return
+
+        chunk = (self.mapping or self.file).read(self.CHUNK_SIZE)
+
+        if not chunk:
+            self.semaphore.release()
+            self.unmap_file()
+            self.consumer.unregisterProducer()
+            self.deferred, deferred = None, self.deferred
+            deferred.callback(None)
+            return
+
+        if self.mapping:
+            self.semaphore.release()  # the mapping is being hashed already
+        else:
+            self.hash_chunk(chunk)
+
+        self.consumer.write(chunk)
+
+        if self.on_chunk:
+            self.on_chunk(chunk)
+
+    def hash_chunk(self, chunk):
+        """
+        Queue the given chunk for hashing in a worker thread.
+        """
+        def release(result):
+            self.semaphore.release()
+            return result
+
+        self.hashed.addCallback(
+            lambda _: deferToThread(self.hasher.update, chunk)
+        )
+        self.hashed.addBoth(release)
+
+    def map_file(self):
+        """
+        Memory-map the file if mapping is enabled and the file is large enough,
+        and queue the whole mapping for hashing. If the file cannot be mapped
+        (e.g. because the storage it resides on does not support it), stick to
+        reading it chunk by chunk.
+        """
+        if self.MMAP_THRESHOLD is None:
+            return
+
+        try:
+            if os.fstat(self.file.fileno()).st_size < self.MMAP_THRESHOLD:
+                return
+            self.mapping = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        except (OSError, ValueError):
+            return
+
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+        mapping = self.mapping
+        self.hashed.addCallback(
+            lambda _: deferToThread(self.hasher.update, mapping)
+        )
+
+    def unmap_file(self):
+        """
+        Close the memory mapping, if there is one, once it has been hashed.
+        """
+        def close(result):
+            mapping.close()
+            return result
+
+        if self.mapping:
+            self.mapping, mapping = None, self.mapping
+            self.hashed.addBoth(close)
+
+    def hexdigest(self):
+        """
+        Return a Deferred that resolves into the hex digest of the data once
+        all the queued chunks have been hashed.
+        """
+        self.hashed.addCallback(lambda _: self.hasher.hexdigest())
+        return self.hashed
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        """
+        Abort the transfer.
+
+        Called by the consumer if, e.g., the connection is lost.
+        """
+        if self.deferred:
+            self.unmap_file()
+            self.deferred, deferred = None, self.deferred
+            deferred.errback(TransferError('The file transfer failed.'))
+
+
 class Wormhole:
     """
     Wrapper around magic wormhole's code that makes it easier to reason about
@@ -83,6 +284,7 @@ class Wormhole:
         Create a magic wormhole.
         """
         self.app_id = app_id
+        self.transit_purpose = '{}/transit-key'.format(self.app_id)
         self.rendezvous_relay = rendezvous_relay
         self.transit_relay = transit_relay
 
@@ -97,8 +299,9 @@ class Wormhole:
 
         self.offer = None
         self.transit = None
+        self.transit_key = None
+        self.transit_message = None
 
-    @inlineCallbacks
     def generate_code(self, timeout=10):
         """
         Generate the code that the users at the two ends of the wormhole will
@@ -106,24 +309,24 @@ class Wormhole:
 
         Return a Deferred that resolves into the code.
         """
-        self.wormhole.allocate_code()
-
-        deferred = self.wormhole.get_code()
+        def handle_error(failure):
+            if failure.check(wormhole.errors.ServerConnectionError):
+                raise ConnectionError((
+                    'The rendezvous server cannot be reached. '
+                    'Please double-check your Internet connection.'
+                ))
+            if failure.check(TimeoutError):
+                raise Timeout('The rendezvous server timed out.')
+            return failure
+
+        # so that an error raised by the upstream also rejects the Deferred
+        deferred = maybeDeferred(self.wormhole.allocate_code)
+        deferred.addCallback(lambda _: self.wormhole.get_code())
         deferred.addTimeout(timeout, reactor)
+        deferred.addErrback(handle_error)
 
-        try:
-            code = yield deferred
-        except wormhole.errors.ServerConnectionError:
-            raise ConnectionError((
-                'The rendezvous server cannot be reached. '
-                'Please double-check your Internet connection.'
-            ))
-        except TimeoutError:
-            raise Timeout('The rendezvous server timed out.')
-
-        return returnValue(code)
+        return deferred
 
-    @inlineCallbacks
     def connect(self, code, timeout=10):
         """
         Connect to another wormhole client by its code generated. This has to
@@ -131,19 +334,19 @@ class Wormhole:
 
         Return a Deferred that resolves upon successful connection.
         """
-        self.wormhole.set_code(code)
-
-        deferred = self.wormhole.get_code()
+        def handle_error(failure):
+            if failure.check(TimeoutError):
+                raise Timeout('The rendezvous server timed out.')
+            return failure
+
+        # e.g. a malformed code is rejected with KeyFormatError
+        deferred = maybeDeferred(self.wormhole.set_code, code)
+        deferred.addCallback(lambda _: self.wormhole.get_code())
         deferred.addTimeout(timeout, reactor)
+        deferred.addErrback(handle_error)
 
-        try:
-            code = yield deferred
-        except TimeoutError:
-            raise Timeout('The rendezvous server timed out.')
-
-        return returnValue(code)
+        return deferred
 
-    @inlineCallbacks
     def exchange_keys(self, timeout=10):
         """
         Return a Deferred that resolves when the key exchange between the two
@@ -152,27 +355,53 @@ class Wormhole:
         The Deferred resolves into the so-called verifier, a hash of the shared
         key, which can be compared by the users at both ends of the wormhole in
         order to make sure no man-in-the-middle attack is taking place.
+
+        If the timeout is None, wait for as long as the wormhole is open.
         """
+        def handle_error(failure):
+            if failure.check(TimeoutError):
+                raise Timeout(
+                    'The key exchange with the other side timed out.'
+                )
+            if failure.check(wormhole.errors.WrongPasswordError):
+                raise HumanError((
+                    'The key exchange with the other side failed. '
+                    'The most probable cause for this is mistyping the code.'
+                ))
+            return failure
+
         deferred = self.wormhole.get_verifier()
-        deferred.addTimeout(timeout, reactor)
+        if timeout is not None:
+            deferred.addTimeout(timeout, reactor)
+        deferred.addErrback(handle_error)
 
-        try:
-            verifier = yield deferred
-        except TimeoutError:
-            raise Timeout('The key exchange with the other side timed out.')
-        except wormhole.errors.WrongPasswordError:
-            raise HumanError((
-                'The key exchange with the other side failed. '
-                'The most probable cause for this is mistyping the code.'
-            ))
+        return deferred
 
-        return returnValue(verifier)
+    def get_transit_key(self):
+        """
+        Return the key for encrypting the transit. This is derived from the
+        wormhole's shared key, so the key exchange should be completed first.
+
+        The key is derived only once and then stored for subsequent calls.
+        """
+        if self.transit_key is None:
+            self.transit_key = self.wormhole.derive_key(
+                self.transit_purpose, self.transit.TRANSIT_KEY_LENGTH
+            )
+
+        return self.transit_key
+
+    def send_message(self, message):
+        """
+        Send an already serialised message down the wormhole.
+        """
+        self.wormhole.send_message(message)
 
     def send_json(self, message):
         """
         Send a JSON message down the wormhole.
         """
-        self.wormhole.send_message(bytes(json.dumps(message), 'utf-8'))
+        self.send_message(dump_json(message))
 
     @inlineCallbacks
     def await_json(self, timeout=600):
@@ -185,12 +414,12 @@ class Wormhole:
 
         try:
             message = yield deferred
-            message = json.loads(str(message, 'utf-8'))
+            message = load_json(message)
         except TimeoutError:
             raise Timeout((
                 'The message exchange with the other side timed out.'
             ))
-        except:
+        except (TypeError, ValueError):  # incl. the JSON decode errors
             raise SuspiciousOperation((
                 'The other side sent a badly formatted message.'
             ))
@@ -198,7 +427,64 @@ class Wormhole:
         return returnValue(message)
 
     @inlineCallbacks
-    def send_file(self, file_path, on_chunk):
+    def send_transit(self):
+        """
+        Send a message with the details needed for establishing the transit.
+        Assume that the latter has been already created.
+
+        The message is put together and serialised only once, so sending it
+        again (e.g. if the other side repeats its own) is cheap.
+
+        Return a Deferred that resolves when the message has been sent.
+        """
+        if self.transit_message is None:
+            try:
+                our_hints = yield self.transit.get_connection_hints()
+                our_abilities = self.transit.get_connection_abilities()
+            except Exception:
+                raise ConnectionError((
+                    'Cannot connect to the transit relay. '
+                    'In case you are not using the default server, '
+                    'you can double-check the URL in the config.'
+                ))
+
+            self.transit_message = dump_json({
+                'transit': {
+                    'abilities-v1': our_abilities,
+                    'hints-v1': our_hints,
+                }
+            })
+
+        self.send_message(self.transit_message)
+
+    @staticmethod
+    def make_offer(file_path, file_name=None, file_size=None):
+        """
+        Return an Offer with the serialised offer message for the given file,
+        to be passed on to the send_file method below. This way the offer can
+        be prepared as soon as the file is chosen, ahead of the sending.
+
+        The name and size of the file can be provided by the caller if already
+        known; otherwise these are looked up here.
+        """
+        if file_name is None:
+            file_name = os.path.basename(file_path)
+        if file_size is None:
+            file_size = os.stat(file_path).st_size  # fails if there is no file
+
+        message = dump_json({
+            'offer': {
+                'file': {
+                    'filename': file_name,
+                    'filesize': file_size,
+                }
+            }
+        })
+
+        return Offer(message, file_name, file_size)
+
+    @inlineCallbacks
+    def send_file(self, file_path, on_chunk, offer=None):
         """
         Send a file down the wormhole. As per the file-transfer protocol this
         involves the following steps:
@@ -207,98 +493,85 @@ class Wormhole:
         - send a message with the offer, i.e. the name and size of the file;
         - run a loop waiting for the response(s) of the other end.
 
+        The offer can be prepared beforehand using the make_offer method. The
+        file is opened before anything is sent, so that a file that has gone
+        missing in the meantime fails here rather than after the other side
+        has accepted it; and the offer is rebuilt if the file's size has
+        changed.
+
         Return a Deferred that resolves when the file has been transferred.
         """
-        assert self.transit is None and os.path.exists(file_path)
+        assert self.transit is None
 
-        self.transit = TransitSender(self.transit_relay)
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
 
-        try:
-            our_hints = yield self.transit.get_connection_hints()
-            our_abilities = self.transit.get_connection_abilities()
-        except Exception:
-            raise ConnectionError((
-                'Cannot connect to the transit relay. '
-                'In case you are not using the default server, '
-                'you can double-check the URL in the config.'
-            ))
+            if offer is None:
+                offer = self.make_offer(file_path, file_size=file_size)
+            elif offer.file_size != file_size:
+                offer = self.make_offer(file_path, offer.file_name, file_size)
 
-        self.send_json({
-            'transit': {
-                'abilities-v1': our_abilities,
-                'hints-v1': our_hints,
-            }
-        })
+            self.transit = TransitSender(self.transit_relay)
 
-        self.send_json({
-            'offer': {
-                'file': {
-                    'filename': os.path.basename(file_path),
-                    'filesize': os.stat(file_path).st_size
-                }
-            }
-        })
+            # the file-transfer protocol requires these to be separate
+            # messages; sent in the same reactor iteration, they are flushed
+            # together
+            yield self.send_transit()
 
-        while True:
-            message = yield self.await_json()
+            self.send_message(offer.message)
 
-            if 'error' in message:
-                yield self.close()
-                raise SuspiciousOperation(str(message['error']))
+            while True:
+                message = yield self.await_json()
 
-            if 'transit' in message:
-                self.transit.add_connection_hints(
-                    message['transit']['hints-v1']
-                )
+                if 'error' in message:
+                    yield self.close()
+                    raise SuspiciousOperation(str(message['error']))
 
-                transit_key = self.wormhole.derive_key(
-                    '{}/transit-key'.format(self.app_id),
-                    self.transit.TRANSIT_KEY_LENGTH
-                )
-                self.transit.set_transit_key(transit_key)
+                if 'transit' in message:
+                    self.transit.add_connection_hints(
+                        message['transit']['hints-v1']
+                    )
 
-            if 'answer' in message:
-                try:
-                    assert message['answer']['file_ack'] == 'ok'
-                except (AssertionError, KeyError):
-                    raise HumanError('The other side declined the file.')
-                else:
-                    hex_digest = yield self.transfer_file(file_path, on_chunk)
-                    return returnValue(hex_digest)
+                    self.transit.set_transit_key(self.get_transit_key())
+
+                if 'answer' in message:
+                    try:
+                        assert message['answer']['file_ack'] == 'ok'
+                    except (AssertionError, KeyError):
+                        raise HumanError('The other side declined the file.')
+                    else:
+                        hex_digest = yield self.transfer_file(f, on_chunk)
+                        return returnValue(hex_digest)
 
     @inlineCallbacks
-    def transfer_file(self, file_path, on_chunk):
+    def transfer_file(self, f, on_chunk):
         """
-        Send a file via the transit. Assume that the latter has been already
-        established. If the other end provides a hash when done, check it.
+        Send an open file via the transit. Assume that the latter has been
+        already established. If the other end provides a hash when done, check
+        it.
 
         Helper for the send_file method above.
         """
         record_pipe = yield self.transit.connect()
-        hasher = hashlib.sha256()
-
-        def transform(data):
-            hasher.update(data)
-            on_chunk(data)
-            return data
 
-        with open(file_path, 'rb') as f:
-            file_sender = FileSender()
-            yield file_sender.beginFileTransfer(f, record_pipe, transform)
+        file_sender = HashingFileSender()
+        yield file_sender.beginFileTransfer(f, record_pipe, on_chunk)
 
         ack_record = yield record_pipe.receive_record()
-        ack_record = json.loads(str(ack_record, 'utf-8'))
+        ack_record = load_json(ack_record)
+
+        hex_digest = yield file_sender.hexdigest()
 
         yield record_pipe.close()
 
         try:
             assert ack_record['ack'] == 'ok'
             if ack_record['sha256']:
-                assert ack_record['sha256'] == hasher.hexdigest()
-        except (AssertionError, KeyError):
+                assert compare_digest(ack_record['sha256'], hex_digest)
+        except (AssertionError, KeyError, TypeError):
             raise TransferError('The file transfer failed.')
 
-        return returnValue(hasher.hexdigest())
+        return returnValue(hex_digest)
 
     @inlineCallbacks
     def await_offer(self):
@@ -315,11 +588,7 @@ class Wormhole:
 
         self.transit = TransitReceiver(self.transit_relay)
 
-        transit_key = self.wormhole.derive_key(
-            '{}/transit-key'.format(self.app_id),
-            self.transit.TRANSIT_KEY_LENGTH
-        )
-        self.transit.set_transit_key(transit_key)
+        self.transit.set_transit_key(self.get_transit_key())
 
         while True:
             message = yield self.await_json()
@@ -333,22 +602,7 @@ class Wormhole:
                     message['transit']['hints-v1']
                 )
 
-                try:
-                    our_hints = yield self.transit.get_connection_hints()
-                    our_abilities = self.transit.get_connection_abilities()
-                except Exception:
-                    raise ConnectionError((
-                        'Cannot connect to the transit relay. '
-                        'In case you are not using the default server, '
-                        'you can double-check the URL in the config.'
-                    ))
-
-                self.send_json({
-                    'transit': {
-                        'abilities-v1': our_abilities,
-                        'hints-v1': our_hints,
-                    }
-                })
+                yield self.send_transit()
 
             if 'offer' in message:
                 self.offer = message['offer']
@@ -368,7 +622,7 @@ class Wormhole:
         size = self.offer['file']['filesize']
         self.offer = None
 
-        self.send_json({'answer': {'file_ack': 'ok'}})
+        self.send_message(FILE_ACK_MESSAGE)
 
         record_pipe = yield self.transit.connect()
         hasher = hashlib.sha256()
@@ -377,7 +631,7 @@ class Wormhole:
             hasher.update(data)
             on_chunk(data)
 
-        with open(file_path, 'wb') as f:
+        with open(file_path, 'wb', buffering=2 ** 20) as f:
             received = yield record_pipe.writeToFile(
                 f, size, progress=None, hasher=callback
             )
@@ -385,13 +639,24 @@ class Wormhole:
             if received != size:
                 raise TransferError('The download could not be completed.')
 
-        ack_record = {'ack': 'ok', 'sha256': hasher.hexdigest()}
-        ack_record = bytes(json.dumps(ack_record), 'utf-8')
+            # the file will not be read again any time soon, so hint the kernel
+            # to start writing it back and to drop its clean pages from the
+            # page cache; this is only a hint, so failing it is not an error
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    f.flush()
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                except OSError:
+                    pass
+
+        hex_digest = hasher.hexdigest()
+
+        ack_record = TRANSFER_ACK_TEMPLATE % hex_digest.encode('ascii')
         yield record_pipe.send_record(ack_record)
 
         yield record_pipe.close()
 
-        return returnValue(hasher.hexdigest())
+        return returnValue(hex_digest)
 
     def close(self):
         """
@@ -1,30 +1,45 @@
 import os
+import stat
 
-import humanize
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.core.clipboard import Clipboard
 from kivy.core.window import Window
 from kivy.factory import Factory
-from kivy.properties import BooleanProperty, ObjectProperty, StringProperty
+from kivy.properties import (
+    BooleanProperty, NumericProperty, ObjectProperty, StringProperty
+)
 from kivy.support import install_twisted_reactor
 from kivy.uix.popup import Popup
 from kivy.uix.screenmanager import NoTransition, Screen, ScreenManager
 from plyer import filechooser
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.threads import deferToThread
 from twisted.python.failure import Failure
 
+# this has to be Twisted's threadedselect reactor, which Kivy interleaves with
+# its own event loop; other reactors (e.g. epoll) want to run the loop instead
 install_twisted_reactor()
 
+from twisted.internet import reactor
+
+# the thread pool only hashes and stats files and resolves shared URIs
+reactor.suggestThreadPoolSize(2)
+
 from config import ConfigMixin, get_config
 from magic import Wormhole
 from cross import (
     ensure_storage_perms, get_downloads_dir, intent_hander, open_file
 )
+from utils import format_size
 
 
 class ErrorPopup(Popup):
     title = StringProperty('Error')
     message = StringProperty('Something bad happened!')
 
+    instance = None
+
     @staticmethod
     def show(error):
         """
@@ -32,6 +47,10 @@ class ErrorPopup(Popup):
 
         The given argument can be either an Exception, or a Twisted Failure, or
         the error message itself as a string.
+
+        The popup is built on the first error and reused for the later ones,
+        only its title and message being changed. If it is still open with an
+        earlier error, a separate popup is built so that neither is lost.
         """
         if isinstance(error, Failure):
             error = error.value
@@ -43,14 +62,72 @@ class ErrorPopup(Popup):
         else:
             title = 'Error'
 
-        Factory.ErrorPopup(title=title, message=message).open()
+        if ErrorPopup.instance is None:
+            ErrorPopup.instance = Factory.ErrorPopup()
+
+        popup = ErrorPopup.instance
+        if popup._is_open:
+            popup = Factory.ErrorPopup()
+
+        popup.title = title
+        popup.message = message
+        popup.open()
+
+
+class ProgressMixin:
+    """
+    Mixin for the send and receive screens that keeps the transferred label up
+    to date during a file transfer. The label is refreshed a few times per
+    second rather than on every chunk, as formatting the size and redrawing
+    the label thousands of times per file would only slow down the transfer.
+
+    The screens' transferred property holds the number of bytes and the label
+    formats it itself, so nothing is formatted unless the number changes.
+    """
+    progress_event = None
+    progress_interval = 0.1
+
+    format_size = staticmethod(format_size)
+
+    def on_chunk(self, chunk):
+        """
+        Count the bytes of a chunk that has been sent or received.
+        """
+        self.bytes_transferred += len(chunk)
+
+    def start_progress(self):
+        """
+        Start refreshing the transferred label periodically.
+        """
+        self.progress_event = Clock.schedule_interval(
+            self.update_progress, self.progress_interval
+        )
+
+    def stop_progress(self, result=None):
+        """
+        Stop refreshing the transferred label and refresh it one last time.
+        Pass through the given result, so that this can be used as a Deferred
+        callback.
+        """
+        if self.progress_event:
+            self.progress_event.cancel()
+            self.progress_event = None
+
+        self.update_progress()
+        return result
+
+    def update_progress(self, dt=None):
+        """
+        Refresh the transferred label.
+        """
+        self.transferred = self.bytes_transferred
 
 
 class HomeScreen(Screen):
     pass
 
 
-class SendScreen(Screen):
+class SendScreen(ProgressMixin, Screen):
     send_button_text = StringProperty('send')
     send_button_disabled = BooleanProperty(False)
 
@@ -59,26 +136,50 @@ class SendScreen(Screen):
 
     file_name = StringProperty('…')
     file_size = StringProperty('…')
-    transferred = StringProperty('…')
+    transferred = NumericProperty(None, allownone=True)
+
+    open_event = None
+    close_event = None
+    close_delay = 30
 
     def on_pre_enter(self):
         """
-        Reset the labels and buttons and init a magic wormhole instance.
+        Reset the labels and buttons and schedule the opening of a magic
+        wormhole. If the wormhole from the user's last visit is still open and
+        unused, keep it and its code instead.
 
         This method is called just before the user enters this screen.
         """
+        self.file_path = None
+        self.file_name = '…'
+        self.file_size = '…'
+        self.offer = None
+
+        self.bytes_transferred = 0
+        self.transferred = None
+
+        if self.close_event:
+            self.close_event.cancel()
+            self.close_event = None
+            return
+
         self.send_button_disabled = True
         self.send_button_text = 'waiting for code'
 
         self.has_code = False
         self.code = '…'
 
-        self.file_path = None
-        self.file_name = '…'
-        self.file_size = '…'
+        self.wormhole = None
+        self.wormhole_used = False
 
-        self.bytes_transferred = 0
-        self.transferred = '…'
+        # in the next frame, so that the screen is shown first
+        self.open_event = Clock.schedule_once(self.open_wormhole, 0)
+
+    def open_wormhole(self, dt=None):
+        """
+        Init a magic wormhole instance and have it generate a code.
+        """
+        self.open_event = None
 
         try:
             self.wormhole = Wormhole(**get_config())
@@ -90,11 +191,12 @@ class SendScreen(Screen):
             self.code = code
             self.send_button_disabled = False
             self.send_button_text = 'send'
-            Clipboard.copy(code)
+            Clock.schedule_once(lambda dt: Clipboard.copy(code))
 
         deferred = self.wormhole.generate_code()
         deferred.addCallbacks(update_code, ErrorPopup.show)
 
+    @inlineCallbacks
     def set_file(self, path):
         """
         Set the file to be sent down the wormhole.
@@ -102,11 +204,21 @@ class SendScreen(Screen):
         This method is called when the the user selects the file to send using
         the file chooser. It is also called directly by the App instance when
         the app has been started or resumed via a send file intent on Android.
+
+        The path is normalised and the file is stat-ed in a worker thread, so
+        that a slow storage does not hold up the UI.
         """
-        try:
+        from humanize import naturalsize  # not needed before this point
+
+        def stat_file(path):
             path = os.path.normpath(path)
-            assert os.path.exists(path) and os.path.isfile(path)
-        except:
+            file_stat = os.stat(path)
+            assert stat.S_ISREG(file_stat.st_mode)
+            return path, file_stat
+
+        try:
+            path, file_stat = yield deferToThread(stat_file, path)
+        except (AssertionError, OSError, TypeError, ValueError):
             ErrorPopup.show((
                 'There is something wrong about the file you chose. '
                 'One possible reason is an issue with some Androids '
@@ -117,11 +229,13 @@ class SendScreen(Screen):
             self.file_path = None
             self.file_name = '…'
             self.file_size = '…'
+            self.offer = None
         else:
             self.file_path = path
             self.file_name = os.path.basename(self.file_path)
-            self.file_size = humanize.naturalsize(
-                os.stat(self.file_path).st_size
+            self.file_size = naturalsize(file_stat.st_size)
+            self.offer = Wormhole.make_offer(
+                path, file_name=self.file_name, file_size=file_stat.st_size
             )
 
     def open_file_chooser(self):
@@ -149,6 +263,7 @@ class SendScreen(Screen):
 
         open_file_chooser()
 
+    @inlineCallbacks
     def send(self):
         """
         Send the selected file down the wormhole.
@@ -156,43 +271,76 @@ class SendScreen(Screen):
         This method is called when the user releases the send button.
         """
         if not self.file_path:
-            return ErrorPopup.show('Please choose a file to send.')
+            ErrorPopup.show('Please choose a file to send.')
+            return
+
+        self.wormhole_used = True
 
-        def exchange_keys():
+        try:
             self.send_button_disabled = True
             self.send_button_text = 'exchanging keys'
-            deferred = self.wormhole.exchange_keys(timeout=600)
-            deferred.addCallbacks(send_file, ErrorPopup.show)
+            yield self.wormhole.exchange_keys(timeout=600)
 
-        def send_file(verifier):
-            self.send_button_disabled = True
             self.send_button_text = 'sending file'
-            deferred = self.wormhole.send_file(self.file_path, on_chunk)
-            deferred.addCallbacks(show_done, ErrorPopup.show)
-
-        def on_chunk(chunk):
-            self.bytes_transferred += len(chunk)
-            self.transferred = humanize.naturalsize(self.bytes_transferred)
+            self.start_progress()
+            try:
+                yield self.wormhole.send_file(
+                    self.file_path, self.on_chunk, offer=self.offer
+                )
+            finally:
+                self.stop_progress()
 
-        def show_done(hex_digest):
-            self.send_button_disabled = True
             self.send_button_text = 'done'
-
-        exchange_keys()
+        except Exception as error:
+            ErrorPopup.show(error)
 
     def on_leave(self):
         """
         Close the magic wormhole instance, if this exists and is still open.
 
+        If the wormhole has got its code but has not been used yet, close it
+        only after a while, so that it can be reused if the user comes back.
+        This saves both the setting up of a new wormhole and the user having
+        to pass on a new code. If the wormhole fails in the meantime (e.g. the
+        other side mistypes the code), close it straight away instead, so that
+        the user gets a new code when they come back.
+
         This method is called when the user leaves this screen.
         """
+        if self.open_event:
+            self.open_event.cancel()
+            self.open_event = None
+
+        if self.has_code and not self.wormhole_used:
+            self.close_event = Clock.schedule_once(
+                self.close_wormhole, self.close_delay
+            )
+
+            wormhole = self.wormhole
+
+            def handle_error(failure):
+                if self.close_event and self.wormhole is wormhole:
+                    self.close_event.cancel()
+                    self.close_wormhole()
+
+            deferred = wormhole.exchange_keys(timeout=None)
+            deferred.addErrback(handle_error)
+        else:
+            self.close_wormhole()
+
+    def close_wormhole(self, dt=None):
+        """
+        Close the magic wormhole instance, if this exists and is still open.
+        """
+        self.close_event = None
+
         try:
             self.wormhole.close()
         except:
             pass  # opening the wormhole failed altogether
 
 
-class ReceiveScreen(Screen):
+class ReceiveScreen(ProgressMixin, Screen):
     connect_button_disabled = BooleanProperty(False)
     connect_button_text = StringProperty('connect')
 
@@ -202,7 +350,18 @@ class ReceiveScreen(Screen):
 
     file_name = StringProperty('…')
     file_size = StringProperty('…')
-    transferred = StringProperty('…')
+    transferred = NumericProperty(None, allownone=True)
+
+    wormhole = None
+
+    def on_kv_post(self, base_widget):
+        """
+        Keep a reference to the code input, so that it does not have to be
+        looked up among the ids every time.
+
+        Called once the kv rules have been applied to this screen.
+        """
+        self.code_input = self.ids.code_input
 
     def on_pre_enter(self):
         """
@@ -221,53 +380,42 @@ class ReceiveScreen(Screen):
         self.file_size = '…'
 
         self.bytes_transferred = 0
-        self.transferred = '…'
+        self.transferred = None
 
-        self.ids.code_input.text = ''
+        self.code_input.text = ''
 
+    @inlineCallbacks
     def open_wormhole(self):
         """
         Called when the user releases the connect button.
         """
-        code = self.ids.code_input.text.strip()
-        code = '-'.join(code.split())
+        code = '-'.join(self.code_input.text.split())
         if not code:
-            return ErrorPopup.show('Please enter a code.')
+            ErrorPopup.show('Please enter a code.')
+            return
 
-        def connect():
+        try:
             self.connect_button_disabled = True
             self.connect_button_text = 'connecting'
+            self.wormhole = Wormhole(**get_config())
+            yield self.wormhole.connect(code)
 
-            try:
-                self.wormhole = Wormhole(**get_config())
-            except Exception as error:
-                return ErrorPopup.show(error)
-
-            deferred = self.wormhole.connect(code)
-            deferred.addCallbacks(exchange_keys, ErrorPopup.show)
-
-        def exchange_keys(code):
-            self.connect_button_disabled = True
             self.connect_button_text = 'exchanging keys'
+            yield self.wormhole.exchange_keys()
 
-            deferred = self.wormhole.exchange_keys()
-            deferred.addCallbacks(await_offer, ErrorPopup.show)
-
-        def await_offer(verifier):
-            self.connect_button_disabled = True
             self.connect_button_text = 'connected'
+            offer = yield self.wormhole.await_offer()
+        except Exception as error:
+            ErrorPopup.show(error)
+            return
 
-            deferred = self.wormhole.await_offer()
-            deferred.addCallbacks(show_offer, ErrorPopup.show)
-
-        def show_offer(offer):
-            self.file_name = str(offer['filename'])
-            self.file_size = humanize.naturalsize(offer['filesize'])
+        from humanize import naturalsize  # not needed before this point
 
-            self.accept_button_disabled = False
-            self.accept_button_text = 'accept'
+        self.file_name = str(offer['filename'])
+        self.file_size = naturalsize(offer['filesize'])
 
-        connect()
+        self.accept_button_disabled = False
+        self.accept_button_text = 'accept'
 
     def accept_offer(self):
         """
@@ -285,13 +433,11 @@ class ReceiveScreen(Screen):
             self.accept_button_disabled = True
             self.accept_button_text = 'receiving'
 
-            deferred = self.wormhole.accept_offer(file_path, on_chunk)
+            self.start_progress()
+            deferred = self.wormhole.accept_offer(file_path, self.on_chunk)
+            deferred.addBoth(self.stop_progress)
             deferred.addCallbacks(show_done, ErrorPopup.show)
 
-        def on_chunk(chunk):
-            self.bytes_transferred += len(chunk)
-            self.transferred = humanize.naturalsize(self.bytes_transferred)
-
         def show_done(hex_digest):
             self.accept_button_disabled = False
             self.accept_button_func = self.open_file
@@ -322,10 +468,9 @@ class ReceiveScreen(Screen):
         """
         Called when the user leaves this screen.
         """
-        try:
+        if self.wormhole is not None:
             self.wormhole.close()
-        except AttributeError:
-            pass
+            self.wormhole = None
 
 
 class WormholeApp(ConfigMixin, App):
@@ -337,14 +482,27 @@ class WormholeApp(ConfigMixin, App):
         Attach the on_keyboard event listener to the Window object.
         """
         self.screen_manager = ScreenManager(transition=NoTransition())
-
-        for screen_cls in [HomeScreen, SendScreen, ReceiveScreen]:
-            self.screen_manager.add_widget(screen_cls())
+        self.screen_manager.add_widget(HomeScreen())
 
         Window.bind(on_keyboard=self.on_keyboard)
 
         return self.screen_manager
 
+    def show_screen(self, name):
+        """
+        Switch to the send or the receive screen. Each of these is only
+        attached the first time the user goes there, rather than in build, so
+        that the app starts up a bit faster.
+        """
+        if not self.screen_manager.has_screen(name):
+            screen_cls = {
+                'send_screen': SendScreen,
+                'receive_screen': ReceiveScreen,
+            }[name]
+            self.screen_manager.add_widget(screen_cls())
+
+        self.screen_manager.current = name
+
     def on_keyboard(self, window, key, *args):
         """
         Called when the keyboard is used for input.
@@ -353,10 +511,13 @@ class WormholeApp(ConfigMixin, App):
         the user is not on the home screen, navigate them there; otherwise let
         them exit the app (the default behaviour).
         """
-        if key == 27:
-            if self.screen_manager.current != 'home_screen':
-                self.screen_manager.current = 'home_screen'
-                return True
+        if key != 27:
+            return False
+
+        screen_manager = self.screen_manager
+        if screen_manager.current != 'home_screen':
+            screen_manager.current = 'home_screen'
+            return True
 
         return False
 
@@ -367,15 +528,14 @@ class WormholeApp(ConfigMixin, App):
         If on Android, check whether the app activity has been started via an
         intent to send a file, and if yes, set the screen accordingly.
         """
-        try:
-            file_path = intent_hander.pop()
-        except ValueError as error:
-            ErrorPopup.show(error)
-        else:
+        def handle_file_path(file_path):
             if file_path is not None:
-                self.screen_manager.current = 'send_screen'
+                self.show_screen('send_screen')
                 self.screen_manager.current_screen.set_file(file_path)
 
+        deferred = intent_hander.pop()
+        deferred.addCallbacks(handle_file_path, ErrorPopup.show)
+
     def on_resume(self):
         """
         Called when the app comes back to the foreground.
@@ -0,0 +1,18 @@
+def format_size(num_bytes):
+    """
+    Return a human-readable representation of the given number of bytes, the
+    same as humanize.naturalsize would but without its overhead.
+    """
+    if num_bytes is None:
+        return '…'
+    if num_bytes == 1:
+        return '1 Byte'
+    if num_bytes < 1000:
+        return '{} Bytes'.format(num_bytes)
+
+    for unit in ('kB', 'MB', 'GB', 'TB', 'PB'):
+        num_bytes /= 1000
+        if round(num_bytes, 1) < 1000:
+            break
+
+    return '{:.1f} {}'.format(num_bytes, unit)
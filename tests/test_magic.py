@@ -1,24 +1,37 @@
+import hashlib
+import json
 import os.path
+from types import SimpleNamespace
 from unittest.mock import Mock
 
 import pytest
 import pytest_twisted
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred, fail, succeed
-from wormhole.errors import WrongPasswordError
+from twisted.internet.testing import StringTransport
+from wormhole.errors import KeyFormatError, WrongPasswordError
 from wormhole.util import dict_to_bytes
 
-from src.magic import HumanError, SuspiciousOperation, Timeout, Wormhole
+from src.magic import (
+    HashingFileSender, HumanError, SuspiciousOperation, Timeout,
+    TransferError, Wormhole
+)
 
 
 @pytest.fixture
 def upstream(monkeypatch):
-    upstream = Mock()
+    upstream = SimpleNamespace(
+        allocate_code=Mock(), close=Mock(), send_message=Mock(),
+        set_code=Mock(),
+    )
 
     def mock_init(self):
         self.app_id = ''
+        self.transit_purpose = '/transit-key'
         self.transit_relay = ''
         self.transit = None
+        self.transit_key = None
+        self.transit_message = None
         self.wormhole = upstream
 
     monkeypatch.setattr(Wormhole, '__init__', mock_init)
@@ -26,6 +39,45 @@ def upstream(monkeypatch):
     return upstream
 
 
+class FakeRecordPipe(StringTransport):
+    """
+    Stand-in for the transit's record pipe. Pull producers registered with it
+    are resumed until they unregister, and the records that the other side
+    would send are given up front.
+    """
+
+    def __init__(self, ack_record=b'', data=b''):
+        super().__init__()
+        self.ack_record = ack_record
+        self.data = data
+        self.records = []
+
+    def registerProducer(self, producer, streaming):
+        super().registerProducer(producer, streaming)
+        self.pump()
+
+    def pump(self):
+        if self.producer:
+            self.producer.resumeProducing()
+            reactor.callLater(0, self.pump)
+
+    def receive_record(self):
+        return succeed(self.ack_record)
+
+    def send_record(self, record):
+        self.records.append(record)
+        return succeed(None)
+
+    def writeToFile(self, f, size, progress=None, hasher=None):
+        data = self.data[:size]
+        f.write(data)
+        hasher(data)
+        return succeed(len(data))
+
+    def close(self):
+        return succeed(None)
+
+
 @pytest.fixture
 def file_path(tmpdir):
     file_path = os.path.join(tmpdir, 'file')
@@ -36,6 +88,74 @@ def file_path(tmpdir):
     return file_path
 
 
+@pytest_twisted.inlineCallbacks
+def test_hashing_file_sender_works(file_path):
+    """
+    The HashingFileSender should write the whole file to the consumer and
+    resolve into the file's hex digest, even if the hashing queue is full.
+    """
+    transport = StringTransport()
+    file_sender = HashingFileSender(max_pending=1)
+    file_sender.CHUNK_SIZE = 1
+
+    with open(file_path, 'rb') as f:
+        deferred = file_sender.beginFileTransfer(f, transport)
+        while not deferred.called:
+            transport.producer.resumeProducing()
+            yield file_sender.hashed
+
+    assert transport.value() == b'hi!'
+
+    res = yield file_sender.hexdigest()
+    assert res == hashlib.sha256(b'hi!').hexdigest()
+
+
+@pytest_twisted.inlineCallbacks
+def test_hashing_file_sender_mmap(file_path):
+    """
+    The HashingFileSender should also work with memory-mapped files.
+    """
+    transport = StringTransport()
+    file_sender = HashingFileSender()
+    file_sender.CHUNK_SIZE = 2
+    file_sender.MMAP_THRESHOLD = 1
+
+    with open(file_path, 'rb') as f:
+        deferred = file_sender.beginFileTransfer(f, transport)
+        assert file_sender.mapping is not None
+
+        while not deferred.called:
+            transport.producer.resumeProducing()
+
+    assert transport.value() == b'hi!'
+    assert file_sender.mapping is None
+
+    res = yield file_sender.hexdigest()
+    assert res == hashlib.sha256(b'hi!').hexdigest()
+
+
+@pytest_twisted.inlineCallbacks
+def test_hashing_file_sender_stop(file_path):
+    """
+    The HashingFileSender should reject with TransferError and stop sending
+    if the consumer aborts the transfer.
+    """
+    transport = StringTransport()
+    file_sender = HashingFileSender()
+    file_sender.CHUNK_SIZE = 1
+
+    with open(file_path, 'rb') as f:
+        deferred = file_sender.beginFileTransfer(f, transport)
+        transport.producer.resumeProducing()
+        file_sender.stopProducing()
+        transport.producer.resumeProducing()
+
+        with pytest.raises(TransferError):
+            yield deferred
+
+    assert transport.value() == b'h'
+
+
 @pytest_twisted.inlineCallbacks
 def test_generate_code_timeout(upstream):
     """
@@ -76,6 +196,21 @@ def test_connect_works(upstream):
     assert res is None
 
 
+@pytest_twisted.inlineCallbacks
+def test_connect_bad_code(upstream):
+    """
+    The Wormhole.connect method should reject rather than raise if the
+    upstream does not accept the code.
+    """
+    upstream.set_code = Mock(side_effect=KeyFormatError())
+
+    wormhole = Wormhole()
+    deferred = wormhole.connect('abc')
+
+    with pytest.raises(KeyFormatError):
+        yield deferred
+
+
 @pytest_twisted.inlineCallbacks
 def test_exchange_keys_bad_code(upstream):
     """
@@ -102,6 +237,60 @@ def test_exchange_keys_works(upstream):
     assert res == 'verifier'
 
 
+@pytest_twisted.inlineCallbacks
+def test_exchange_keys_no_timeout(upstream):
+    """
+    The Wormhole.exchange_keys method should wait indefinitely if the timeout
+    is None.
+    """
+    def get_verifier():
+        deferred = Deferred()
+        reactor.callLater(0.1, deferred.callback, 'verifier')
+        return deferred
+    upstream.get_verifier = get_verifier
+
+    wormhole = Wormhole()
+    res = yield wormhole.exchange_keys(timeout=None)
+    assert res == 'verifier'
+
+
+def test_get_transit_key_works(upstream):
+    """
+    The Wormhole.get_transit_key method should derive the key only once.
+    """
+    upstream.derive_key = Mock(return_value=bytes('key', 'utf-8'))
+
+    wormhole = Wormhole()
+    wormhole.transit = Mock(TRANSIT_KEY_LENGTH=32)
+
+    assert wormhole.get_transit_key() == bytes('key', 'utf-8')
+    assert wormhole.get_transit_key() == bytes('key', 'utf-8')
+    upstream.derive_key.assert_called_once_with('/transit-key', 32)
+
+
+@pytest_twisted.inlineCallbacks
+def test_send_transit_works(upstream):
+    """
+    The Wormhole.send_transit method should gather the transit details only
+    once, even if the message is sent more than once.
+    """
+    wormhole = Wormhole()
+    wormhole.transit = Mock()
+    wormhole.transit.get_connection_hints = Mock(return_value=succeed([]))
+    wormhole.transit.get_connection_abilities = Mock(return_value=[])
+
+    yield wormhole.send_transit()
+    yield wormhole.send_transit()
+
+    assert wormhole.transit.get_connection_hints.call_count == 1
+    assert upstream.send_message.call_count == 2
+
+    message = upstream.send_message.call_args.args[0]
+    assert json.loads(message) == {
+        'transit': {'abilities-v1': [], 'hints-v1': []}
+    }
+
+
 @pytest_twisted.inlineCallbacks
 def test_await_json_timeout(upstream):
     """
@@ -144,6 +333,38 @@ def test_await_json_works(upstream):
     assert res == {'answer': 42}
 
 
+@pytest_twisted.inlineCallbacks
+def test_await_json_utf8(upstream):
+    """
+    The Wormhole.await_json method should parse the upstream's bytes as UTF-8
+    without them having to be decoded first.
+    """
+    message = {'offer': {'file': {'filename': 'čaj.txt', 'filesize': 3}}}
+    upstream.get_message = lambda: succeed(dict_to_bytes(message))
+
+    wormhole = Wormhole()
+    res = yield wormhole.await_json()
+    assert res == message
+
+
+def test_make_offer_works(file_path):
+    """
+    The Wormhole.make_offer method should look up the name and size of the
+    file unless these are provided.
+    """
+    offer = Wormhole.make_offer(file_path)
+    assert (offer.file_name, offer.file_size) == ('file', 3)
+
+    res = json.loads(offer.message)
+    assert res == {'offer': {'file': {'filename': 'file', 'filesize': 3}}}
+
+    offer = Wormhole.make_offer(file_path, 'name', 42)
+    assert (offer.file_name, offer.file_size) == ('name', 42)
+
+    res = json.loads(offer.message)
+    assert res == {'offer': {'file': {'filename': 'name', 'filesize': 42}}}
+
+
 @pytest_twisted.inlineCallbacks
 def test_send_file_error(upstream, file_path):
     """
@@ -161,6 +382,46 @@ def test_send_file_error(upstream, file_path):
     assert upstream.close.called
 
 
+@pytest_twisted.inlineCallbacks
+def test_send_file_missing(upstream, file_path):
+    """
+    The Wormhole.send_file method should fail before sending anything if the
+    file has gone missing since the offer was made.
+    """
+    offer = Wormhole.make_offer(file_path)
+    os.remove(file_path)
+
+    wormhole = Wormhole()
+
+    with pytest.raises(FileNotFoundError):
+        yield wormhole.send_file(file_path, lambda _: None, offer=offer)
+
+    assert not upstream.send_message.called
+
+
+@pytest_twisted.inlineCallbacks
+def test_send_file_stale_offer(upstream, file_path):
+    """
+    The Wormhole.send_file method should update the offer's file size if the
+    file has changed since the offer was made.
+    """
+    offer = Wormhole.make_offer(file_path, 'name')
+    with open(file_path, 'a') as f:
+        f.write('!')
+
+    upstream.get_message = lambda: succeed(dict_to_bytes({'error': '!'}))
+
+    wormhole = Wormhole()
+
+    with pytest.raises(SuspiciousOperation):
+        yield wormhole.send_file(file_path, lambda _: None, offer=offer)
+
+    message = upstream.send_message.call_args.args[0]
+    assert json.loads(message) == {
+        'offer': {'file': {'filename': 'name', 'filesize': 4}}
+    }
+
+
 @pytest_twisted.inlineCallbacks
 def test_await_offer_error(upstream):
     """
@@ -177,3 +438,128 @@ def test_await_offer_error(upstream):
 
     assert str(exc_info.value) == '!'
     assert upstream.close.called
+
+
+@pytest_twisted.inlineCallbacks
+def test_transfer_file_works(upstream, file_path):
+    """
+    The Wormhole.transfer_file method should send the whole file and resolve
+    into its hex digest if the other side acknowledges the same digest.
+    """
+    hex_digest = hashlib.sha256(b'hi!').hexdigest()
+    pipe = FakeRecordPipe(dict_to_bytes({'ack': 'ok', 'sha256': hex_digest}))
+
+    wormhole = Wormhole()
+    wormhole.transit = SimpleNamespace(connect=lambda: succeed(pipe))
+
+    with open(file_path, 'rb') as f:
+        res = yield wormhole.transfer_file(f, lambda _: None)
+
+    assert res == hex_digest
+    assert pipe.value() == b'hi!'
+
+
+@pytest_twisted.inlineCallbacks
+def test_transfer_file_bad_digest(upstream, file_path):
+    """
+    The Wormhole.transfer_file method should reject with TransferError if the
+    other side acknowledges a different digest.
+    """
+    pipe = FakeRecordPipe(dict_to_bytes({'ack': 'ok', 'sha256': 'abc'}))
+
+    wormhole = Wormhole()
+    wormhole.transit = SimpleNamespace(connect=lambda: succeed(pipe))
+
+    with open(file_path, 'rb') as f:
+        with pytest.raises(TransferError):
+            yield wormhole.transfer_file(f, lambda _: None)
+
+
+@pytest_twisted.inlineCallbacks
+def test_transfer_file_bad_ack(upstream, file_path):
+    """
+    The Wormhole.transfer_file method should reject with TransferError if the
+    other side's ack is not a JSON object.
+    """
+    pipe = FakeRecordPipe(b'["ok"]')
+
+    wormhole = Wormhole()
+    wormhole.transit = SimpleNamespace(connect=lambda: succeed(pipe))
+
+    with open(file_path, 'rb') as f:
+        with pytest.raises(TransferError):
+            yield wormhole.transfer_file(f, lambda _: None)
+
+
+@pytest_twisted.inlineCallbacks
+def test_accept_offer_works(upstream, tmpdir):
+    """
+    The Wormhole.accept_offer method should accept the offer, write the file,
+    and send back an ack with the file's hex digest.
+    """
+    pipe = FakeRecordPipe(data=b'hi!')
+    file_path = os.path.join(tmpdir, 'file')
+
+    wormhole = Wormhole()
+    wormhole.offer = {'file': {'filename': 'file', 'filesize': 3}}
+    wormhole.transit = SimpleNamespace(connect=lambda: succeed(pipe))
+
+    on_chunk = Mock()
+    res = yield wormhole.accept_offer(file_path, on_chunk)
+
+    hex_digest = hashlib.sha256(b'hi!').hexdigest()
+    assert res == hex_digest
+
+    with open(file_path, 'rb') as f:
+        assert f.read() == b'hi!'
+
+    on_chunk.assert_called_once_with(b'hi!')
+
+    message = upstream.send_message.call_args.args[0]
+    assert json.loads(message) == {'answer': {'file_ack': 'ok'}}
+
+    assert len(pipe.records) == 1
+    assert json.loads(pipe.records[0]) == {'ack': 'ok', 'sha256': hex_digest}
+
+
+@pytest_twisted.inlineCallbacks
+def test_accept_offer_incomplete(upstream, tmpdir):
+    """
+    The Wormhole.accept_offer method should reject with TransferError and
+    send no ack if fewer bytes arrive than offered.
+    """
+    pipe = FakeRecordPipe(data=b'hi')
+
+    wormhole = Wormhole()
+    wormhole.offer = {'file': {'filename': 'file', 'filesize': 3}}
+    wormhole.transit = SimpleNamespace(connect=lambda: succeed(pipe))
+
+    with pytest.raises(TransferError):
+        yield wormhole.accept_offer(os.path.join(tmpdir, 'file'), Mock())
+
+    assert pipe.records == []
+
+
+@pytest.mark.skipif(
+    not hasattr(os, 'posix_fadvise'), reason='no posix_fadvise here'
+)
+@pytest_twisted.inlineCallbacks
+def test_accept_offer_fadvise_error(upstream, tmpdir, monkeypatch):
+    """
+    The Wormhole.accept_offer method should not fail a completed download if
+    the page cache hint fails.
+    """
+    def posix_fadvise(*args):
+        raise OSError()
+    monkeypatch.setattr(os, 'posix_fadvise', posix_fadvise)
+
+    pipe = FakeRecordPipe(data=b'hi!')
+
+    wormhole = Wormhole()
+    wormhole.offer = {'file': {'filename': 'file', 'filesize': 3}}
+    wormhole.transit = SimpleNamespace(connect=lambda: succeed(pipe))
+
+    res = yield wormhole.accept_offer(os.path.join(tmpdir, 'file'), Mock())
+
+    assert res == hashlib.sha256(b'hi!').hexdigest()
+    assert len(pipe.records) == 1
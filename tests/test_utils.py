@@ -0,0 +1,14 @@
+import pytest
+from humanize import naturalsize
+
+from src.utils import format_size
+
+
+@pytest.mark.parametrize('num_bytes', [
+    0, 1, 999, 1000, 1049, 999949, 999950, 10 ** 6, 999999999, 10 ** 15,
+])
+def test_format_size_works(num_bytes):
+    """
+    The format_size function should format sizes as humanize.naturalsize does.
+    """
+    assert format_size(num_bytes) == naturalsize(num_bytes)